@@ -1,13 +1,26 @@
 import streamlit as st
-import pandas as pd
-from groq import Groq
-from pdf2image import convert_from_path
+# pandas, groq/httpx, pdf2image, pytesseract y datasketch se importan dentro de
+# las funciones que los usan: la primera pantalla se pinta sin esperar a cargarlos.
+import pypdfium2 as pdfium
+from PIL import Image
 import tempfile
 import os
-import json
+import shutil
 import time
 import base64
 import io
+import asyncio
+import threading
+import hashlib
+import codecs
+import re
+from types import MappingProxyType
+import diskcache
+from concurrent.futures import Future, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+from collections import deque
+from typing import Annotated
+from pydantic import BaseModel, BeforeValidator, ConfigDict, ValidationError
 
 # --- CONFIGURACIÓN ---
 st.set_page_config(page_title="Nexus Extractor (Motor Groq)", layout="wide")
@@ -15,11 +28,76 @@ st.title("⚡ Nexus Extractor: Motor Llama 4 Vision (Groq)")
 
 # 1. Configurar Cliente Groq
 if "GROQ_API_KEY" in st.secrets:
-    client = Groq(api_key=st.secrets["GROQ_API_KEY"])
+    GROQ_API_KEY = st.secrets["GROQ_API_KEY"]
 else:
     st.error("❌ Falta la API KEY de Groq. Configura 'GROQ_API_KEY' en secrets.")
     st.stop()
 
+# 2. Límites de la cuenta Groq (ajustar según el plan contratado)
+MODELO_VISION = "meta-llama/llama-4-scout-17b-16e-instruct"
+MODELO_TEXTO = "llama-3.3-70b-versatile"   # Páginas con texto nativo (sin visión)
+MODELO_TEXTO_RAPIDO = "llama-3.1-8b-instant"  # Primera pasada; si no basta, se repite con el 70B
+GROQ_RPM = 30                 # Peticiones por minuto (por modelo)
+GROQ_TPM = 30000              # Tokens por minuto (por modelo)
+TOKENS_POR_PAGINA = 3000      # Estimación (imagen + prompt + respuesta) por página
+MAX_CONCURRENCIA = 5          # Lotes de páginas en vuelo por archivo (acota la memoria)
+MAX_PETICIONES_EN_VUELO = 8   # Peticiones a Groq a la vez, sumando todos los archivos
+MAX_ARCHIVOS_PARALELO = 4     # PDFs procesados a la vez
+MAX_INTENTOS = 3              # Intentos por página ante HTTP 429 o fallos transitorios
+ESPERA_MAX_429 = 60           # Tope (s) de espera entre intentos
+HILOS_RASTER = max(1, (os.cpu_count() or 2) - 1)  # Procesos pdftoppm en paralelo
+PAGINAS_POR_BLOQUE = max(4, HILOS_RASTER)         # Páginas rasterizadas por llamada (a disco, no a RAM)
+MAX_TOKENS_RESPUESTA = 4096   # Por página
+MAX_TOKENS_LOTE = 8192        # Tope de salida del modelo de visión
+# Páginas escaneadas enviadas juntas en una petición de visión: solo las que caben con su
+# presupuesto completo de salida (un lote truncado en modo JSON falla entero)
+PAGINAS_POR_LOTE = MAX_TOKENS_LOTE // MAX_TOKENS_RESPUESTA
+
+# Una página se trata como texto nativo (no se rasteriza) si su capa de texto es suficiente
+MIN_CARACTERES_TEXTO = 200
+MIN_LINEAS_TEXTO = 10
+MAX_CARACTERES_SIN_FILTRO = 8000  # Páginas de texto más largas se filtran antes de enviarse
+MAX_LINEAS_TEXTO = 3000
+LINEAS_ENCABEZADO = 15        # Siempre se conservan (emisor, cliente, número, fecha)
+MAX_CARACTERES_POR_PETICION = 24000  # (~8k tokens) Por encima, la página se reparte en trozos paralelos
+TAM_TROZO_TEXTO = 8000        # Líneas de items por trozo (más el encabezado)
+NOTA_CONTEXTO = "CONTEXTO (encabezado de la página, ya procesado: NO extraigas items de estas líneas):\n"
+NOTA_LINEAS_TROZO = "\nLÍNEAS A EXTRAER:\n"
+_RE_LINEA_UTIL = re.compile(r"\d|(?i:brand|origin|invoice|marca|origen|factura|total|cliente|fecha)")
+
+# Pre-filtro local de copias: evita gastar una llamada a Groq en páginas que se descartan
+ANCHO_PRE_OCR = 612           # ~72 dpi en tamaño carta
+NIVEL_TINTA = 160             # Gris por debajo del cual un píxel cuenta como tinta
+MAX_TINTA_BLANCO = 0.0001     # Fracción de celdas con tinta bajo la que una página está en blanco (casi cero)
+AVISO_PAGINA_BLANCA = "Página en blanco, omitida (sin llamar a Groq)."
+LINEAS_SELLO = 10             # El sello COPIA/DUPLICADO se busca solo en el encabezado...
+FRACCION_SELLO = 0.25         # ...(primeras líneas de texto o franja superior del escaneo)
+MAX_PALABRAS_SELLO = 3        # ...y en una línea corta, tipo sello ("COPIA", "*** DUPLICADO ***")
+_RE_COPIA = re.compile(r"\b(DUPLICADO|COPIA)\b")
+_RE_ORIGINAL = re.compile(r"\bORIGINAL\b")
+_RE_VALLA_JSON = re.compile(r"^```(?:json)?\s*|\s*```$", re.MULTILINE)  # Envoltorio Markdown
+_RE_OBJETO_JSON = re.compile(r"\{.*\}", re.DOTALL)                     # Del primer { al último }
+_FACTURAS_INVALIDAS = frozenset({"", "none", "null", "continuacion", "pendiente"})  # Arrastrar la anterior
+
+# 3. Calidad de imagen enviada al modelo (más píxeles no mejoran la lectura)
+DPI_DEFECTO = 150
+DPI_POR_TIPO = {"Factura Goodyear": 200}   # Tablas densas: letra pequeña en muchas líneas
+CALIDAD_JPEG_DEFECTO = 75
+LADO_MAX_IMAGEN = 1568        # Tamaño nativo de entrada del modelo de visión
+TEMPERATURA = 0.1
+
+# 4. Caché de respuestas en disco (clave = prompt + modelo + temperatura + imagen/texto)
+RUTA_CACHE = os.path.expanduser("~/.nexus_cache")
+MODOS_CACHE = ["Activado", "Refrescar", "Solo lectura", "Replay (sin API)", "Desactivado"]
+ERROR_REPLAY = "Página sin respuesta en caché (modo Replay)."
+PREFIJO_ERROR_429 = "Error Groq: límite de peticiones superado"
+# Páginas de texto casi idénticas (MinHash de 5-gramas de palabras) reutilizan la respuesta guardada
+SIMILITUD_MIN = 0.8           # Umbral del índice LSH; el slider filtra por encima
+PERMUTACIONES_MINHASH = 128
+TAM_SHINGLE = 5
+_RE_PALABRA = re.compile(r"\w+")
+_RE_NUMERO = re.compile(r"-?\d[\d.,]*")  # Primer número de un campo ("USD 1,234.50")
+
 # ==========================================
 # 🧠 DEFINICIÓN DE PROMPTS (MEJORADO GOODYEAR)
 # ==========================================
@@ -81,107 +159,842 @@ PROMPTS_POR_TIPO = {
     """
 }
 
+# Se añade al prompt de la plantilla cuando se envían varias páginas en una sola petición
+INSTRUCCION_LOTE = """
+        LOTE DE PÁGINAS: Recibes {n} imágenes, que son páginas del mismo PDF en orden.
+        Analiza CADA imagen por separado aplicando todas las reglas anteriores.
+        Responde SOLAMENTE con este JSON, con exactamente {n} elementos (uno por imagen, en el mismo orden):
+        {{"paginas": [<JSON de la imagen 1>, <JSON de la imagen 2>, ...]}}
+"""
+
+# Mensajes listos para enviar, construidos una sola vez (solo lectura, compartidos).
+# El prompt va siempre primero como mensaje "system" idéntico byte a byte en todas las
+# páginas, para que Groq pueda reutilizar el prefijo ya procesado.
+PROMPTS_MSG = MappingProxyType({
+    prompt: {"role": "system", "content": prompt} for prompt in PROMPTS_POR_TIPO.values()
+})
+PROMPTS_LOTE_MSG = MappingProxyType({
+    n: {"type": "text", "text": INSTRUCCION_LOTE.format(n=n)} for n in range(2, PAGINAS_POR_LOTE + 1)
+})
+NOTA_TEXTO = "NOTA: La página se entrega como el texto extraído del PDF, no como imagen.\n\nTEXTO DE LA PÁGINA:\n"
+
+# ==========================================
+# 📐 ESQUEMA DE RESPUESTA (parseo + validación en una pasada)
+# ==========================================
+def _a_numero(valor):
+    """Número desde lo que devuelva el modelo: "1,234.50", "1.234,50", "USD 5", "2 PCS".
+
+    Lo que no se pueda leer ("N/A", "", listas...) queda en None en vez de tumbar la página.
+    """
+    if isinstance(valor, bool):
+        return None
+    if isinstance(valor, (int, float)):
+        return valor
+    if not isinstance(valor, str):
+        return None
+    m = _RE_NUMERO.search(valor)
+    if not m:
+        return None
+    numero = m.group().rstrip(".,")
+    coma, punto = numero.rfind(","), numero.rfind(".")
+    if coma >= 0 and punto >= 0:
+        # Con ambos separadores, el último es el decimal
+        miles, decimal = (".", ",") if coma > punto else (",", ".")
+        numero = numero.replace(miles, "").replace(decimal, ".")
+    elif coma >= 0:
+        # "1,234" / "1,234,567" -> miles; "12,5" -> decimal
+        if numero.count(",") > 1 or len(numero) - coma - 1 == 3:
+            numero = numero.replace(",", "")
+        else:
+            numero = numero.replace(",", ".")
+    elif numero.count(".") > 1:
+        numero = numero.replace(".", "")  # "1.234.567"
+    try:
+        return float(numero)
+    except ValueError:
+        return None
+
+Numero = Annotated[float | None, BeforeValidator(_a_numero)]
+
+class _EsquemaLaxo(BaseModel):
+    # El modelo a veces devuelve códigos numéricos (ej: 111530) donde esperamos texto
+    model_config = ConfigDict(coerce_numbers_to_str=True)
+
+class ItemFactura(_EsquemaLaxo):
+    modelo: str | None = None
+    descripcion: str | None = None
+    cantidad: Numero = None
+    precio_unitario: Numero = None
+    total_linea: Numero = None
+
+class Factura(_EsquemaLaxo):
+    tipo_documento: str | None = None
+    numero_factura: str | None = None
+    fecha: str | None = None
+    orden_compra: str | None = None
+    proveedor: str | None = None
+    cliente: str | None = None
+    items: Annotated[list[ItemFactura], BeforeValidator(lambda v: v or [])] = []
+    total_factura: Numero = None
+
+class LotePaginas(_EsquemaLaxo):
+    paginas: Annotated[list[Factura], BeforeValidator(lambda v: v or [])] = []
+
+# Columnas de la tabla de items (se construye por columnas, no por filas)
+COLUMNAS_ITEMS = (*ItemFactura.model_fields, "Archivo_Origen", "Factura_Origen")
+TIPOS_ITEMS = {
+    "cantidad": "float32", "precio_unitario": "float64", "total_linea": "float64",
+    # Se repiten en cada fila de la misma factura: categóricas, un código por fila
+    "Archivo_Origen": "category", "Factura_Origen": "category",
+}
+
 # ==========================================
 # 🛠️ FUNCIONES AUXILIARES
 # ==========================================
-def codificar_imagen(image):
-    buffered = io.BytesIO()
-    image.save(buffered, format="JPEG")
-    return base64.b64encode(buffered.getvalue()).decode('utf-8')
+def nuevas_columnas_items():
+    return {col: [] for col in COLUMNAS_ITEMS}
+
+def tabla_items(columnas):
+    import pandas as pd
+    return pd.DataFrame(columnas, copy=False).astype(TIPOS_ITEMS)
+
+@st.cache_data(max_entries=8, show_spinner=False)
+def exportar_csv(tablas):
+    """Escribe las tablas de cada archivo una tras otra en un único buffer, sin concatenarlas.
+
+    Memoizado: los reruns de Streamlit (cambiar un widget, descargar) no regeneran el CSV.
+    Lleva BOM para que Excel lo abra directamente con acentos y ñ correctos.
+    """
+    buffer = io.BytesIO()
+    buffer.write(codecs.BOM_UTF8)
+    for i, tabla in enumerate(tablas):
+        tabla.to_csv(buffer, index=False, header=(i == 0), encoding="utf-8")
+    return buffer.getvalue()
+
+def clave_cache(prompt_sistema, modelo, contenido):
+    h = hashlib.sha256()
+    for parte in (prompt_sistema, modelo, str(TEMPERATURA), contenido):
+        h.update(parte.encode())
+        h.update(b"|")
+    return h.hexdigest()
+
+def leer_cache(cache, clave, esquema):
+    """Respuesta guardada en disco, validada de nuevo con `esquema`.
+
+    En disco solo se guarda JSON: los modelos Pydantic viven en el script de Streamlit
+    (__main__ distinto en cada ejecución) y no se pueden picklear de forma fiable.
+    Entradas ilegibles o de formato antiguo cuentan como fallo de caché.
+    """
+    try:
+        guardado = cache.get(clave)
+    except Exception:
+        return None
+    if not isinstance(guardado, str):
+        return None
+    try:
+        return esquema.model_validate_json(guardado)
+    except ValidationError:
+        return None
+
+def guardar_cache(cache, clave, data):
+    """Guarda la respuesta como JSON; si el disco falla, la respuesta (ya pagada) no se pierde."""
+    try:
+        cache.set(clave, data.model_dump_json())
+    except Exception:
+        pass
+
+def extraer_textos_pdf(pdf_path):
+    """Capa de texto de cada página (cadena vacía en páginas escaneadas)."""
+    textos = []
+    pdf = pdfium.PdfDocument(pdf_path)
+    try:
+        for page in pdf:
+            textpage = page.get_textpage()
+            textos.append(textpage.get_text_range())
+            textpage.close()
+            page.close()
+    finally:
+        pdf.close()
+    return textos
+
+@st.cache_data(max_entries=32, show_spinner=False)
+def textos_pdf_en_cache(huella, _pdf_path):
+    """extraer_textos_pdf memorizado por el hash del archivo (la ruta temporal no entra en la clave)."""
+    return extraer_textos_pdf(_pdf_path)
+
+def firma_minhash(texto):
+    """MinHash de los 5-gramas de palabras de la página (para detectar casi duplicados)."""
+    from datasketch import MinHash
+    palabras = _RE_PALABRA.findall(texto.lower())
+    shingles = {" ".join(palabras[i:i + TAM_SHINGLE]) for i in range(max(1, len(palabras) - TAM_SHINGLE + 1))}
+    firma = MinHash(num_perm=PERMUTACIONES_MINHASH)
+    firma.update_batch([s.encode() for s in shingles])
+    return firma
+
+def filtrar_texto(texto):
+    """Quita la letra pequeña de páginas largas: encabezado + líneas que parecen filas de factura."""
+    if len(texto) < MAX_CARACTERES_SIN_FILTRO:
+        return texto
+    lineas = texto.splitlines()
+    utiles = [ln for ln in lineas[LINEAS_ENCABEZADO:] if _RE_LINEA_UTIL.search(ln)]
+    return "\n".join(lineas[:LINEAS_ENCABEZADO] + utiles[:MAX_LINEAS_TEXTO])
+
+def partir_texto(texto):
+    """Reparte una página larga en trozos por líneas. Devuelve (encabezado, trozos).
+
+    El primer trozo lleva el encabezado como texto normal; los demás lo llevan solo como
+    contexto, marcado para que el modelo no vuelva a extraer sus filas.
+    """
+    lineas = texto.splitlines()
+    encabezado = "\n".join(lineas[:LINEAS_ENCABEZADO])
+    trozos, actual, tamano = [], [], 0
+    for linea in lineas[LINEAS_ENCABEZADO:]:
+        if actual and tamano + len(linea) > TAM_TROZO_TEXTO:
+            trozos.append(actual)
+            actual, tamano = [], 0
+        actual.append(linea)
+        tamano += len(linea) + 1
+    if actual:
+        trozos.append(actual)
+    return encabezado, [
+        (NOTA_CONTEXTO + encabezado + NOTA_LINEAS_TROZO if n else encabezado + "\n") + "\n".join(trozo)
+        for n, trozo in enumerate(trozos)
+    ]
+
+def combinar_facturas(partes, encabezado):
+    """Une las respuestas de los trozos de una página: cada campo del primero que lo traiga + los items.
+
+    Si el modelo repite en un trozo posterior una fila del encabezado (ya devuelta por el
+    primero), esa repetición se descarta.
+    """
+    campos = {
+        campo: next((getattr(p, campo) for p in partes if getattr(p, campo) is not None), None)
+        for campo in Factura.model_fields if campo != "items"
+    }
+    primeros = partes[0].items
+    del_encabezado = [
+        item for item in primeros
+        if any(valor and valor in encabezado for valor in (item.modelo, item.descripcion))
+    ]
+    items = list(primeros)
+    for parte in partes[1:]:
+        items.extend(item for item in parte.items if item not in del_encabezado)
+    return Factura.model_construct(**campos, items=items)
+
+def es_pagina_de_texto(texto):
+    return len(texto) > MIN_CARACTERES_TEXTO and texto.count("\n") > MIN_LINEAS_TEXTO
+
+def iterar_paginas(pdf_path, textos, dpi=DPI_DEFECTO):
+    """Entrega (indice, pagina) de una en una: el texto si la página es nativa, o la imagen.
+
+    Solo se rasterizan las páginas escaneadas, por bloques de páginas consecutivas
+    (memoria acotada).
+    """
+    n_paginas = len(textos)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        rutas = deque()
+        from pdf2image import convert_from_path
+        for i, texto in enumerate(textos):
+            if es_pagina_de_texto(texto):
+                yield i, texto
+                continue
+            if not rutas:
+                fin = i
+                while (fin + 1 < n_paginas and fin + 1 - i < PAGINAS_POR_BLOQUE
+                       and not es_pagina_de_texto(textos[fin + 1])):
+                    fin += 1
+                rutas.extend(convert_from_path(
+                    pdf_path, dpi=dpi, first_page=i + 1, last_page=fin + 1,
+                    output_folder=tmpdir, paths_only=True,
+                    thread_count=HILOS_RASTER, fmt="jpeg", jpegopt={"quality": 95},
+                ))
+            ruta = rutas.popleft()
+            img = Image.open(ruta)
+            img.load()
+            os.unlink(ruta)
+            yield i, img
+
+PREFIJO_DATA_URL = b"data:image/jpeg;base64,"
+_TLS = threading.local()  # Un buffer JPEG reutilizable por hilo de codificación
+
+def parece_copia(pagina):
+    """True si el encabezado trae un sello COPIA/DUPLICADO (y no ORIGINAL).
+
+    Solo cuentan líneas cortas del encabezado: "PAPEL BOND PARA COPIA CARTA" en una línea
+    de items no descarta la página. Ante la duda, False -> Groq decide.
+    """
+    if isinstance(pagina, str):
+        texto = pagina
+    else:
+        franja = pagina.crop((0, 0, pagina.width, int(pagina.height * FRACCION_SELLO)))
+        pequena = franja.convert("L").reduce(max(1, pagina.width // ANCHO_PRE_OCR))
+        try:
+            import pytesseract
+            texto = pytesseract.image_to_string(pequena, lang="spa")
+        except Exception:
+            return False
+    encabezado = [linea.strip().upper() for linea in texto.splitlines() if linea.strip()][:LINEAS_SELLO]
+    if any(_RE_ORIGINAL.search(linea) for linea in encabezado):
+        return False
+    return any(
+        _RE_COPIA.search(linea) and len(linea.split()) <= MAX_PALABRAS_SELLO for linea in encabezado
+    )
+
+def pagina_en_blanco(imagen):
+    """True si la página escaneada casi no tiene tinta (separadores, reversos vacíos).
+
+    La máscara de tinta se calcula a resolución completa antes de reducir: así un trazo fino
+    no se diluye en el promedio y basta una línea de texto para que la página se procese.
+    """
+    mascara = imagen.convert("L").point(lambda gris: 255 if gris < NIVEL_TINTA else 0)
+    pequena = mascara.reduce(max(1, imagen.width // ANCHO_PRE_OCR))
+    celdas_con_tinta = pequena.width * pequena.height - pequena.histogram()[0]
+    return celdas_con_tinta <= MAX_TINTA_BLANCO * pequena.width * pequena.height
+
+def codificar_imagen(image, calidad=CALIDAD_JPEG_DEFECTO):
+    """Devuelve la página como data URL JPEG, codificando sin copias intermedias del buffer."""
+    image.thumbnail((LADO_MAX_IMAGEN, LADO_MAX_IMAGEN), Image.LANCZOS)
+    buffered = getattr(_TLS, "buffer", None)
+    if buffered is None:
+        buffered = _TLS.buffer = io.BytesIO()
+    # Se sobrescribe desde el inicio y se lee solo lo escrito: sin truncar, la memoria se reutiliza
+    buffered.seek(0)
+    image.save(buffered, format="JPEG", quality=calidad, optimize=True, progressive=True)
+    n_bytes = buffered.tell()
+    with buffered.getbuffer() as vista, vista[:n_bytes] as jpeg:
+        return (PREFIJO_DATA_URL + base64.b64encode(jpeg)).decode("ascii")
+
+def extraer_objeto_json(texto):
+    """Primer objeto {...} completo del texto, contando llaves fuera de las cadenas (O(n)).
+
+    Devuelve None si no hay ninguno cerrado.
+    """
+    inicio = texto.find("{")
+    if inicio < 0:
+        return None
+    profundidad, en_cadena, escapado = 0, False, False
+    for pos in range(inicio, len(texto)):
+        c = texto[pos]
+        if en_cadena:
+            if escapado:
+                escapado = False
+            elif c == "\\":
+                escapado = True
+            elif c == '"':
+                en_cadena = False
+        elif c == '"':
+            en_cadena = True
+        elif c == "{":
+            profundidad += 1
+        elif c == "}":
+            profundidad -= 1
+            if profundidad == 0:
+                return texto[inicio:pos + 1]
+    return None
+
+def validar_respuesta(esquema, texto):
+    """Parsea la respuesta con el parser nativo de Pydantic; si el modelo la envolvió en
+    un bloque ```json ... ``` o añadió texto alrededor, se rescata el objeto y se reintenta."""
+    try:
+        return esquema.model_validate_json(texto)
+    except ValidationError:
+        limpio = _RE_VALLA_JSON.sub("", texto)
+        objeto = extraer_objeto_json(limpio)
+        if objeto is None and "}" in limpio:  # Sin "}" la regex solo retrocedería en vano
+            coincidencia = _RE_OBJETO_JSON.search(limpio)
+            objeto = coincidencia and coincidencia.group(0)
+        if not objeto or objeto == texto:
+            raise
+        return esquema.model_validate_json(objeto)
+
+class LimitadorGroq:
+    """Cubeta de tokens doble (peticiones + tokens) para respetar los límites RPM/TPM de Groq.
+
+    Se comparte entre todos los archivos y sesiones en proceso; el lock es de hilos y
+    nunca se duerme con él tomado.
+    """
+
+    def __init__(self, rpm, tpm):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.request_tokens = rpm
+        self.token_tokens = tpm
+        self.ultima_recarga = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _recargar(self):
+        ahora = time.monotonic()
+        transcurrido = ahora - self.ultima_recarga
+        self.ultima_recarga = ahora
+        self.request_tokens = min(self.rpm, self.request_tokens + transcurrido * self.rpm / 60)
+        self.token_tokens = min(self.tpm, self.token_tokens + transcurrido * self.tpm / 60)
+
+    async def adquirir(self, tokens):
+        tokens = min(tokens, self.tpm)
+        while True:
+            with self.lock:
+                self._recargar()
+                if self.request_tokens >= 1 and self.token_tokens >= tokens:
+                    self.request_tokens -= 1
+                    self.token_tokens -= tokens
+                    return
+                wait_time = max(
+                    (1 - self.request_tokens) * 60 / self.rpm,
+                    (tokens - self.token_tokens) * 60 / self.tpm,
+                )
+            await asyncio.sleep(wait_time)
+
+class MotorGroq:
+    """Recursos compartidos por todas las peticiones a Groq, vivos entre reruns de Streamlit.
+
+    Un AsyncGroq queda ligado al event loop donde abre sus conexiones, así que el motor
+    mantiene su propio loop en un hilo: el pool HTTP/2 (keep-alive + sesión TLS) se
+    reutiliza en todas las páginas, archivos y reruns en lugar de recrearse cada vez.
+    """
+
+    def __init__(self, api_key):
+        from groq import AsyncGroq, DefaultAsyncHttpxClient
+        import httpx
+        self.loop = asyncio.new_event_loop()
+        threading.Thread(target=self.loop.run_forever, name="motor-groq", daemon=True).start()
+        # Los reintentos los gestionamos nosotros (respetando Retry-After y sin ocupar el semáforo)
+        self.client = AsyncGroq(
+            api_key=api_key,
+            max_retries=0,
+            http_client=DefaultAsyncHttpxClient(
+                http2=True,
+                limits=httpx.Limits(max_connections=32, max_keepalive_connections=32),
+            ),
+        )
+        self.cache = diskcache.Cache(RUTA_CACHE)
+        # Uno por modelo: todos los usuarios comparten la misma API KEY y sus límites
+        self.limitadores = {modelo: LimitadorGroq(GROQ_RPM, GROQ_TPM) for modelo in (MODELO_VISION, MODELO_TEXTO, MODELO_TEXTO_RAPIDO)}
+        # Global, no por archivo: con varios PDFs a la vez el tope de peticiones no se multiplica
+        self.semaforo = asyncio.Semaphore(MAX_PETICIONES_EN_VUELO)
+        # Índice de casi duplicados (en memoria, solo se toca desde el loop del motor)
+        self.indice_lsh = None  # Se crea al primer uso (datasketch solo se carga si hace falta)
+        self.firmas = {}  # clave de caché -> (prompt, firma)
+
+    def buscar_similar(self, prompt_sistema, firma, similitud):
+        """Respuesta en caché de una página con el mismo prompt y Jaccard estimado >= similitud."""
+        if self.indice_lsh is None:
+            return None
+        for clave in self.indice_lsh.query(firma):
+            prompt, firma_guardada = self.firmas[clave]
+            if prompt == prompt_sistema and firma_guardada.jaccard(firma) >= similitud:
+                data = leer_cache(self.cache, clave, Factura)
+                if data is not None:
+                    return data
+        return None
+
+    def registrar_similar(self, prompt_sistema, clave, firma):
+        if self.indice_lsh is None:
+            from datasketch import MinHashLSH
+            self.indice_lsh = MinHashLSH(threshold=SIMILITUD_MIN, num_perm=PERMUTACIONES_MINHASH)
+        if clave not in self.firmas:
+            self.firmas[clave] = (prompt_sistema, firma)
+            self.indice_lsh.insert(clave, firma)
+
+    def ejecutar(self, corrutina):
+        """Corre la corrutina en el loop del motor y espera su resultado (desde cualquier hilo)."""
+        return asyncio.run_coroutine_threadsafe(corrutina, self.loop).result()
+
+@st.cache_resource
+def obtener_motor():
+    return MotorGroq(GROQ_API_KEY)
 
 # ==========================================
 # 🧠 LÓGICA DE ANÁLISIS
 # ==========================================
-def analizar_pagina(image, prompt_sistema):
+async def analizar_imagenes(motor, imagenes, prompt_sistema, semaforo, modo_cache, cache_sesion, calidad):
+    """Analiza varias páginas escaneadas en una sola petición (menos viajes de ida y vuelta).
+
+    Devuelve un (data, error) por imagen. Si el lote falla o su respuesta no cuadra
+    página a página, se repite con una petición por página (salvo 429 o fallo en Replay,
+    que se repetirían igual).
+    """
+    try:
+        urls = await asyncio.gather(*(asyncio.to_thread(codificar_imagen, img, calidad) for img in imagenes))
+    except Exception as e:
+        return [(None, f"Error codificando imagen: {e}")] * len(imagenes)
+
+    if len(urls) > 1:
+        contenido = [PROMPTS_LOTE_MSG[len(urls)]]
+        contenido += [{"type": "image_url", "image_url": {"url": url}} for url in urls]
+        data, error = await consultar_groq(
+            motor, MODELO_VISION, prompt_sistema, "\n".join(urls), contenido,
+            semaforo, modo_cache, cache_sesion, n_paginas=len(urls),
+        )
+        if error and (error.startswith(PREFIJO_ERROR_429) or error == ERROR_REPLAY):
+            return [(None, error)] * len(urls)
+        if not error and len(data.paginas) == len(urls):
+            return [(pagina, None) for pagina in data.paginas]
+
+    return list(await asyncio.gather(*(
+        analizar_pagina(motor, url, prompt_sistema, semaforo, modo_cache, cache_sesion) for url in urls
+    )))
+
+async def analizar_pagina(motor, url_imagen, prompt_sistema, semaforo, modo_cache, cache_sesion):
+    contenido = [
+        {
+            "type": "image_url",
+            "image_url": {"url": url_imagen},
+        },
+    ]
+    return await consultar_groq(
+        motor, MODELO_VISION, prompt_sistema, url_imagen, contenido, semaforo, modo_cache, cache_sesion
+    )
+
+def respuesta_suficiente(data, error):
+    """La primera pasada vale si no hubo error y trajo items (o la página es una copia)."""
+    return not error and (bool(data.items) or "copia" in (data.tipo_documento or "").lower())
+
+async def analizar_texto(motor, texto, prompt_sistema, semaforo, modo_cache, cache_sesion, similitud=1.0,
+                         texto_rapido=True):
+    """Con `similitud` < 1, una página casi idéntica a otra ya respondida reutiliza su respuesta.
+
+    Con `texto_rapido` la página va primero al modelo pequeño y solo se escala al grande
+    si la respuesta no es suficiente. Las páginas muy largas se reparten en trozos.
+    """
+    texto = filtrar_texto(texto)
+    if len(texto) > MAX_CARACTERES_POR_PETICION:
+        # Map-reduce: trozos en paralelo (prefill corto en cada uno) y se juntan sus items
+        encabezado, trozos = partir_texto(texto)
+        partes = await asyncio.gather(*(
+            _analizar_texto_entero(motor, trozo, prompt_sistema, semaforo, modo_cache, cache_sesion,
+                                   similitud, texto_rapido)
+            for trozo in trozos
+        ))
+        error = next((error for _, error in partes if error), None)
+        if error:
+            return None, error
+        return combinar_facturas([data for data, _ in partes], encabezado), None
+    return await _analizar_texto_entero(
+        motor, texto, prompt_sistema, semaforo, modo_cache, cache_sesion, similitud, texto_rapido
+    )
+
+async def _analizar_texto_entero(motor, texto, prompt_sistema, semaforo, modo_cache, cache_sesion, similitud,
+                                 texto_rapido):
+    contenido = NOTA_TEXTO + texto
+    buscar_similar = similitud < 1 and modo_cache not in ("Desactivado", "Refrescar")
+    if buscar_similar:
+        firma = await asyncio.to_thread(firma_minhash, texto)
+        data = motor.buscar_similar(prompt_sistema, firma, similitud)
+        if data is not None:
+            return data, None
+    for modelo in (MODELO_TEXTO_RAPIDO, MODELO_TEXTO) if texto_rapido else (MODELO_TEXTO,):
+        resultado = await consultar_groq(
+            motor, modelo, prompt_sistema, texto, contenido, semaforo, modo_cache, cache_sesion
+        )
+        if respuesta_suficiente(*resultado):
+            break
+    if buscar_similar and not resultado[1]:
+        motor.registrar_similar(prompt_sistema, clave_cache(prompt_sistema, modelo, texto), firma)
+    return resultado
+
+async def consultar_groq(motor, modelo, prompt_sistema, pagina, contenido, semaforo, modo_cache, cache_sesion,
+                         n_paginas=1):
+    """Caché + límites de Groq alrededor de una llamada. `pagina` (data URL o texto) forma la clave.
+
+    Con `n_paginas` > 1 la respuesta es un LotePaginas en lugar de una Factura.
+
+    `cache_sesion` deduplica páginas idénticas dentro de la sesión, incluso mientras la
+    primera sigue en vuelo: las repetidas esperan su Future en lugar de llamar otra vez.
+    """
+    if modo_cache == "Desactivado":
+        return await _consultar_cache_o_groq(
+            motor, modelo, prompt_sistema, None, contenido, semaforo, modo_cache, n_paginas
+        )
+
+    clave = clave_cache(prompt_sistema, modelo, pagina)
+    propio = Future()
+    previo = cache_sesion.setdefault(clave, propio)
+    if previo is not propio:
+        return await asyncio.wrap_future(previo)
+
+    try:
+        resultado = await _consultar_cache_o_groq(
+            motor, modelo, prompt_sistema, clave, contenido, semaforo, modo_cache, n_paginas
+        )
+    except BaseException as e:
+        # Las páginas que esperan este Future reciben el fallo como un error normal (no una
+        # cancelación que tumbaría su tarea y, con ella, el archivo entero)
+        cache_sesion.pop(clave, None)
+        propio.set_result((None, f"Error inesperado: {e!r}"))
+        raise
+    if resultado[1]:
+        cache_sesion.pop(clave, None)  # Los errores no se recuerdan: se reintenta la próxima vez
+    propio.set_result(resultado)
+    return resultado
+
+async def _consultar_cache_o_groq(motor, modelo, prompt_sistema, clave, contenido, semaforo, modo_cache, n_paginas):
+    # 1. Consultar la caché antes de gastar una llamada a Groq
+    cache = motor.cache
+    if modo_cache not in ("Desactivado", "Refrescar"):
+        data = leer_cache(cache, clave, LotePaginas if n_paginas > 1 else Factura)
+        if data is not None:
+            return data, None
+        if modo_cache == "Replay (sin API)":
+            return None, ERROR_REPLAY
+
+    from groq import APIConnectionError, APIStatusError, RateLimitError
+
+    # 2. Llamada real, respetando concurrencia y límites RPM/TPM.
+    #    Ante un 429 se espera lo que indique Groq (fuera del semáforo) y se reintenta;
+    #    red caída, timeouts, 408/409 y 5xx se reintentan igual (el SDK va con max_retries=0).
+    for intento in range(1, MAX_INTENTOS + 1):
+        async with semaforo:
+            await motor.limitadores[modelo].adquirir(TOKENS_POR_PAGINA * n_paginas)
+            try:
+                data, error = await _llamar_groq(motor, modelo, prompt_sistema, contenido, n_paginas)
+                break
+            except RateLimitError as e:
+                data, error = None, f"{PREFIJO_ERROR_429} ({e})"
+                espera = espera_reintento(e, intento)
+            except (APIConnectionError, APIStatusError) as e:
+                data, error = None, f"Error Groq: {str(e)}"
+                espera = espera_reintento(e, intento)
+        if intento < MAX_INTENTOS:
+            await asyncio.sleep(espera)
+
+    if not error and modo_cache in ("Activado", "Refrescar"):
+        guardar_cache(cache, clave, data)
+    return data, error
+
+def espera_reintento(error, intento):
+    """Segundos a esperar antes de reintentar: el Retry-After de Groq o, si falta, backoff exponencial."""
     try:
-        base64_image = codificar_imagen(image)
-        chat_completion = client.chat.completions.create(
+        espera = float(error.response.headers["retry-after"])
+    except (KeyError, ValueError, AttributeError):
+        espera = 2 ** intento
+    return min(espera, ESPERA_MAX_429)
+
+def es_reintentable(error):
+    """429, fallos de conexión/timeout y 408/409/5xx: vale la pena volver a intentarlo."""
+    from groq import APIConnectionError, APIStatusError
+    if isinstance(error, APIConnectionError):  # Incluye APITimeoutError
+        return True
+    return isinstance(error, APIStatusError) and (
+        error.status_code in (408, 409, 429) or error.status_code >= 500
+    )
+
+async def _llamar_groq(motor, modelo, prompt_sistema, contenido, n_paginas=1):
+    esquema = LotePaginas if n_paginas > 1 else Factura
+    try:
+        chat_completion = await motor.client.chat.completions.create(
             messages=[
+                PROMPTS_MSG[prompt_sistema],
                 {
                     "role": "user",
-                    "content": [
-                        {"type": "text", "text": prompt_sistema},
-                        {
-                            "type": "image_url",
-                            "image_url": {"url": f"data:image/jpeg;base64,{base64_image}"},
-                        },
-                    ],
+                    "content": contenido,
                 }
             ],
-            model="meta-llama/llama-4-scout-17b-16e-instruct", 
-            temperature=0.1,
-            max_tokens=4096,
+            model=modelo,
+            temperature=TEMPERATURA,
+            max_tokens=MAX_TOKENS_RESPUESTA * n_paginas,
             stream=False,
             response_format={"type": "json_object"}, 
         )
         texto_respuesta = chat_completion.choices[0].message.content
-        return json.loads(texto_respuesta), None
+        return validar_respuesta(esquema, texto_respuesta), None
     except Exception as e:
+        if es_reintentable(e):
+            raise  # Lo reintenta _consultar_cache_o_groq
         if "model_decommissioned" in str(e):
-             return {}, "⚠️ Modelo antiguo. Contacta soporte."
-        return {}, f"Error Groq: {str(e)}"
+             return None, "⚠️ Modelo antiguo. Contacta soporte."
+        return None, f"Error Groq: {str(e)}"
+
+async def analizar_paginas(motor, paginas, n_paginas, prompt, al_avanzar, modo_cache, cache_sesion, calidad,
+                           similitud=1.0, texto_rapido=True):
+    """Lanza las páginas a Groq en paralelo y devuelve los resultados en orden de página.
+
+    Las páginas se consumen del iterador según se liberan huecos, así que nunca hay
+    más de MAX_CONCURRENCIA lotes en memoria. Las páginas con texto nativo van
+    al modelo de texto; las escaneadas consecutivas se agrupan de PAGINAS_POR_LOTE
+    en PAGINAS_POR_LOTE para el de visión.
+    """
+    semaforo = motor.semaforo
+    resultados = [None] * n_paginas
+    completadas = 0
+
+    async def tarea(grupo):
+        # grupo = [(indice, pagina)]: una página de texto o varias escaneadas consecutivas
+        try:
+            copias = await asyncio.gather(*(asyncio.to_thread(parece_copia, p) for _, p in grupo))
+            salida = [(i, (None, None)) for (i, _), copia in zip(grupo, copias) if copia]  # Sin llamar a Groq
+            resto = [(i, p) for (i, p), copia in zip(grupo, copias) if not copia]
+            if resto and isinstance(resto[0][1], str):
+                i, texto = resto[0]
+                salida.append((i, await analizar_texto(
+                    motor, texto, prompt, semaforo, modo_cache, cache_sesion, similitud, texto_rapido
+                )))
+            elif resto:
+                analisis = await analizar_imagenes(
+                    motor, [p for _, p in resto], prompt, semaforo, modo_cache, cache_sesion, calidad
+                )
+                salida.extend(zip((i for i, _ in resto), analisis))
+            return salida
+        finally:
+            for _, p in grupo:
+                if not isinstance(p, str):
+                    p.close()
+
+    def recoger(terminadas):
+        # Como gather(return_exceptions=True): un fallo inesperado solo afecta a sus páginas
+        nonlocal completadas
+        for t in terminadas:
+            indices = indices_por_tarea.pop(t)
+            if t.cancelled():
+                salida = [(i, (None, "Error inesperado: tarea cancelada")) for i in indices]
+            elif t.exception() is not None:
+                salida = [(i, (None, f"Error inesperado: {t.exception()}")) for i in indices]
+            else:
+                salida = t.result()
+            for i, resultado in salida:
+                resultados[i] = resultado
+                completadas += 1
+        al_avanzar(completadas / n_paginas)
+
+    pendientes = set()
+    indices_por_tarea = {}
+    lote = []
+
+    async def lanzar(grupo):
+        nonlocal pendientes
+        t = asyncio.create_task(tarea(grupo))
+        indices_por_tarea[t] = [i for i, _ in grupo]
+        pendientes.add(t)
+        if len(pendientes) >= MAX_CONCURRENCIA:
+            terminadas, pendientes = await asyncio.wait(pendientes, return_when=asyncio.FIRST_COMPLETED)
+            recoger(terminadas)
+
+    error_lectura = None
+    try:
+        while True:
+            siguiente = await asyncio.to_thread(next, paginas, None)
+            if siguiente is None:
+                break
+            if isinstance(siguiente[1], str):
+                if lote:
+                    await lanzar(lote)
+                    lote = []
+                await lanzar([siguiente])
+            elif await asyncio.to_thread(pagina_en_blanco, siguiente[1]):
+                # Nada que extraer: se resuelve aquí sin llamar a Groq
+                siguiente[1].close()
+                resultados[siguiente[0]] = (None, AVISO_PAGINA_BLANCA)
+                completadas += 1
+                al_avanzar(completadas / n_paginas)
+            else:
+                lote.append(siguiente)
+                if len(lote) == PAGINAS_POR_LOTE:
+                    await lanzar(lote)
+                    lote = []
+        if lote:
+            await lanzar(lote)
+    except asyncio.CancelledError:
+        for t in pendientes:
+            t.cancel()
+        raise
+    except Exception as e:
+        # Falló la lectura/render de una página: lo ya lanzado termina y el resto queda como error
+        for _, p in lote:
+            p.close()
+        error_lectura = f"Error leyendo página: {e}"
+    if pendientes:
+        terminadas, _ = await asyncio.wait(pendientes)
+        recoger(terminadas)
+    if error_lectura:
+        for i, resultado in enumerate(resultados):
+            if resultado is None:
+                resultados[i] = (None, error_lectura)
+
+    return [r for r in resultados if r is not None]
 
 # ==========================================
 # ⚙️ PROCESAMIENTO
 # ==========================================
-def procesar_pdf(pdf_path, filename, tipo_seleccionado):
+def procesar_pdf(pdf_path, filename, tipo_seleccionado, modo_cache="Activado",
+                 dpi=DPI_DEFECTO, calidad=CALIDAD_JPEG_DEFECTO, al_avanzar=lambda fraccion: None,
+                 cache_sesion=None, similitud=1.0, huella=None, texto_rapido=True):
+    """Procesa un PDF completo. No escribe en la interfaz: puede correr en un hilo aparte.
+
+    Devuelve (resumen, tabla_items, errores); el avance se notifica con `al_avanzar(fraccion)`.
+    `cache_sesion` (dict) comparte respuestas de páginas repetidas entre archivos y ejecuciones.
+    `similitud` < 1 deja que páginas de texto casi idénticas reutilicen respuestas de la caché.
+    `huella` (hash del contenido) permite reutilizar la capa de texto ya extraída en otro rerun.
+    `texto_rapido` envía las páginas de texto primero al modelo pequeño (con respaldo en el grande).
+    """
+    if cache_sesion is None:
+        cache_sesion = {}
     prompt = PROMPTS_POR_TIPO[tipo_seleccionado]
     try:
-        images = convert_from_path(pdf_path, dpi=200)
+        textos = textos_pdf_en_cache(huella, pdf_path) if huella else extraer_textos_pdf(pdf_path)
+        n_paginas = len(textos)
     except Exception as e:
-        return [], [], f"Error leyendo PDF: {e}"
+        return [], tabla_items(nuevas_columnas_items()), [f"Error leyendo PDF: {e}"]
 
-    items_locales = []
+    items_cols = nuevas_columnas_items()
     resumen_local = []
+    vistos_resumen = set()  # (factura, archivo) ya presentes en resumen_local
+    errores = []
     
     # VARIABLE PARA ARRASTRAR EL NÚMERO DE FACTURA ENTRE PÁGINAS
     ultimo_numero_factura = "S/N"
     
-    my_bar = st.progress(0, text=f"Analizando {filename}...")
+    paginas = iterar_paginas(pdf_path, textos, dpi)
+    try:
+        motor = obtener_motor()
+        resultados = motor.ejecutar(analizar_paginas(
+            motor, paginas, n_paginas, prompt, al_avanzar, modo_cache, cache_sesion, calidad, similitud,
+            texto_rapido,
+        ))
+    except Exception as e:
+        return [], tabla_items(nuevas_columnas_items()), [f"Error leyendo PDF: {e}"]
+    finally:
+        paginas.close()
 
-    for i, img in enumerate(images):
-        data, error = analizar_pagina(img, prompt)
-        
-        if error:
-            st.error(f"Error {filename} Pág {i+1}: {error}")
+    # El post-proceso va en orden de página para arrastrar bien el número de factura
+    for i, (data, error) in enumerate(resultados):
+        if error == AVISO_PAGINA_BLANCA:
+            errores.append(f"Aviso {filename} Pág {i+1}: {error}")
+        elif error:
+            errores.append(f"Error {filename} Pág {i+1}: {error}")
         
         # Filtro de Copias
-        elif not data or "copia" in str(data.get("tipo_documento", "")).lower():
+        elif data is None or "copia" in (data.tipo_documento or "").lower():
             pass 
         else:
             # LÓGICA INTELIGENTE DE FACTURA
-            factura_actual = str(data.get("numero_factura", "")).strip()
+            factura_actual = (data.numero_factura or "").strip()
             
             # Si la IA no encontró factura o dice "CONTINUACION", usamos la de la página anterior
-            if not factura_actual or factura_actual.lower() in ["none", "null", "continuacion", "pendiente"] or len(factura_actual) < 3:
+            if factura_actual.casefold() in _FACTURAS_INVALIDAS or len(factura_actual) < 3:
                 factura_id = ultimo_numero_factura
             else:
                 factura_id = factura_actual
                 ultimo_numero_factura = factura_actual # Actualizamos para las siguientes páginas
 
-            # Guardamos Items
-            if "items" in data and isinstance(data["items"], list):
-                for item in data["items"]:
-                    item["Archivo_Origen"] = filename
-                    item["Factura_Origen"] = factura_id
-                    items_locales.append(item)
+            # Guardamos Items: columna a columna por página; el origen se replica de una vez
+            n_items = len(data.items)
+            for campo in ItemFactura.model_fields:
+                items_cols[campo].extend([getattr(item, campo) for item in data.items])
+            items_cols["Archivo_Origen"].extend([filename] * n_items)
+            items_cols["Factura_Origen"].extend([factura_id] * n_items)
             
             # Guardamos Resumen (Solo si encontramos una factura nueva o es la pág 1)
             # Evitamos duplicados en la tabla resumen
-            ya_existe = any(d['Factura'] == factura_id and d['Archivo'] == filename for d in resumen_local)
-            if not ya_existe and factura_id != "S/N":
+            clave_resumen = (factura_id, filename)
+            if clave_resumen not in vistos_resumen and factura_id != "S/N":
+                vistos_resumen.add(clave_resumen)
                 resumen_local.append({
                     "Archivo": filename,
                     "Factura": factura_id,
-                    "Total": data.get("total_factura"),
-                    "Cliente": data.get("cliente")
+                    "Total": data.total_factura,
+                    "Cliente": data.cliente
                 })
-        
-        my_bar.progress((i + 1) / len(images))
-        time.sleep(0.5) 
 
-    my_bar.empty()
-    return resumen_local, items_locales, None
+    return resumen_local, tabla_items(items_cols), errores
 
 # ==========================================
 # 🖥️ INTERFAZ
@@ -189,6 +1002,25 @@ def procesar_pdf(pdf_path, filename, tipo_seleccionado):
 with st.sidebar:
     st.header("Configuración")
     tipo_pdf = st.selectbox("Plantilla:", list(PROMPTS_POR_TIPO.keys()))
+    modo_cache = st.selectbox(
+        "Caché de respuestas:", MODOS_CACHE,
+        help="Refrescar: vuelve a llamar a Groq y sobrescribe la caché. Solo lectura: usa la caché "
+             "sin guardar. Replay: nunca llama a Groq (iterar sin coste).",
+    )
+    # Un slider por plantilla: al cambiarla se recupera su DPI recomendado (o el último elegido)
+    dpi = st.slider("Resolución (DPI):", 100, 300, DPI_POR_TIPO.get(tipo_pdf, DPI_DEFECTO), step=25,
+                    key=f"dpi_{tipo_pdf}",
+                    help="Más DPI = más fidelidad en tablas densas, pero más lento.")
+    calidad_jpeg = st.slider("Calidad JPEG:", 40, 95, CALIDAD_JPEG_DEFECTO, step=5)
+    similitud = st.slider(
+        "Reutilizar páginas de texto similares:", SIMILITUD_MIN, 1.0, 1.0, step=0.01,
+        help="Similitud mínima (Jaccard) para reusar la respuesta de una página casi idéntica. "
+             "1.00 = solo páginas exactamente iguales.",
+    )
+    texto_rapido = st.checkbox(
+        "Texto nativo: modelo rápido (8B) primero", value=True,
+        help="Las páginas con texto van a Llama 3.1 8B; si no devuelve items, se repiten con Llama 3.3 70B.",
+    )
     st.success("⚡ Motor Groq (Llama 4 Vision)")
 
 uploaded_files = st.file_uploader("Sube Facturas (PDF)", type=["pdf"], accept_multiple_files=True)
@@ -196,28 +1028,78 @@ uploaded_files = st.file_uploader("Sube Facturas (PDF)", type=["pdf"], accept_mu
 if uploaded_files and st.button("🚀 Procesar con Groq"):
     gran_acumulado = []
     st.divider()
+
+    # 1. Volcar cada PDF a disco y reservar su caja de resultados (en orden de subida)
+    trabajos = []
+    huellas = []
     for uploaded_file in uploaded_files:
-        with st.expander(f"📄 {uploaded_file.name}", expanded=True):
-            with st.spinner(f"Enviando a Groq LPU..."):
-                with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as tmp:
-                    tmp.write(uploaded_file.read())
-                    path = tmp.name
-                    fname = uploaded_file.name
-                
-                resumen, items, error = procesar_pdf(path, fname, tipo_pdf)
-                os.remove(path)
-                
-                if items:
-                    df = pd.DataFrame(items)
-                    st.success(f"✅ {len(items)} items extraídos.")
-                    st.dataframe(df, use_container_width=True)
-                    gran_acumulado.extend(items)
-                elif error:
-                    st.error(error)
+        with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as tmp:
+            uploaded_file.seek(0)
+            shutil.copyfileobj(uploaded_file, tmp, length=1024 * 1024)
+            path = tmp.name
+            fname = uploaded_file.name
+        caja = st.status(f"📄 {fname}", expanded=True)
+        barra = caja.progress(0, text=f"Analizando {fname}...")
+        trabajos.append((fname, path, caja, barra))
+        huellas.append(hashlib.blake2b(uploaded_file.getbuffer(), digest_size=16).hexdigest())
+
+    # 2. Procesar los archivos en paralelo; la interfaz solo se toca desde este hilo
+    avance = [0.0] * len(trabajos)
+    mostrado = [0.0] * len(trabajos)  # Último valor enviado a cada barra
+    if modo_cache == "Refrescar":
+        st.session_state["cache_paginas"] = {}  # Tampoco valen las respuestas ya vistas en la sesión
+    cache_sesion = st.session_state.setdefault("cache_paginas", {})
+    with ThreadPoolExecutor(
+        max_workers=MAX_ARCHIVOS_PARALELO,
+        initializer=add_script_run_ctx, initargs=(None, get_script_run_ctx()),
+    ) as ex:
+        futuros = {
+            ex.submit(
+                procesar_pdf, path, fname, tipo_pdf, modo_cache, dpi, calidad_jpeg,
+                lambda fraccion, i=i: avance.__setitem__(i, fraccion), cache_sesion, similitud, huellas[i],
+                texto_rapido,
+            ): i
+            for i, (fname, path, _, _) in enumerate(trabajos)
+        }
+        pendientes = set(futuros)
+        while pendientes:
+            terminados, pendientes = wait(pendientes, timeout=0.1, return_when=FIRST_COMPLETED)
+            # Como mucho un mensaje por barra cada 100 ms, y solo si el avance cambió
+            for i in (futuros[f] for f in pendientes):
+                if avance[i] != mostrado[i]:
+                    mostrado[i] = avance[i]
+                    trabajos[i][3].progress(avance[i], text=f"Analizando {trabajos[i][0]}...")
+
+            for futuro in terminados:
+                fname, path, caja, barra = trabajos[futuros[futuro]]
+                try:
+                    resumen, items, errores = futuro.result()
+                except Exception as e:
+                    # Un archivo que falla no tapa a los demás: el error va en su propia caja
+                    caja.error(f"❌ Error procesando {fname}: {e}")
+                    caja.update(state="error")
+                    continue
+                finally:
+                    os.remove(path)
+                    barra.empty()
+
+                for error in errores:
+                    (caja.warning if error.startswith("Aviso") else caja.error)(error)
+                if len(items):
+                    facturas = ", ".join(items["Factura_Origen"].cat.categories)
+                    caja.success(f"✅ {len(items)} items extraídos. Facturas: {facturas}")
+                    caja.dataframe(items, use_container_width=True)
+                    gran_acumulado.append(items)
+                    caja.update(state="complete")
                 else:
-                    st.warning("⚠️ Sin datos (Copia o vacío).")
+                    caja.warning("⚠️ Sin datos (Copia o vacío).")
+                    fallos = [e for e in errores if not e.startswith("Aviso")]
+                    caja.update(state="error" if fallos else "complete")
 
-    if gran_acumulado:
-        st.divider()
-        csv = pd.DataFrame(gran_acumulado).to_csv(index=False).encode('utf-8')
-        st.download_button("📥 Descargar Todo (CSV)", csv, "extraccion_groq.csv", "text/csv")
+    # Se guarda en la sesión para que la descarga sobreviva a los reruns
+    st.session_state["items_extraidos"] = gran_acumulado
+
+if st.session_state.get("items_extraidos"):
+    st.divider()
+    csv = exportar_csv(st.session_state["items_extraidos"])
+    st.download_button("📥 Descargar Todo (CSV)", csv, "extraccion_groq.csv", "text/csv")